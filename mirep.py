@@ -2,18 +2,33 @@
 
 import argparse
 import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.util.retry import Retry
 import os
 import lzma
 import logging
-import subprocess
-from urllib.parse import urlparse
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import re
+import queue
+from collections import deque
+import threading
+import fnmatch
+from urllib.parse import urlparse, unquote
+from concurrent.futures import ThreadPoolExecutor, Future
 from tqdm import tqdm
 import gzip
 import shutil
 import sys
 import hashlib
+import json
+import time
 from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
+
+try:
+    import gnupg  # Optional, only needed to verify Release signatures
+except ImportError:
+    gnupg = None
 
 
 '''
@@ -29,6 +44,25 @@ from datetime import datetime
 
 VERSION = "0.1.10"
 
+# Size of the blocks read from the network and written to disk
+CHUNK_SIZE = 1 << 17
+
+# Matches the relative links of an Apache/nginx directory index, skipping
+# sort links ("?C=N;O=D") and absolute links to other parts of the server
+HREF_PATTERN = re.compile(rb'href="([^"?/][^"]*)"')
+
+# Signed files describing a distribution
+RELEASE_FILES = ("InRelease", "Release", "Release.gpg")
+
+# Fields of a Packages record that are actually used
+PACKAGE_FIELDS = {field.encode(): field for field in ("Package", "Version", "Description", "Filename", "SHA256", "Size")}
+
+# Packages index parsing: records are separated by blank lines, a field runs
+# until the next line that does not start with a space or a tab
+RECORD_SEPARATOR = re.compile(rb'\n(?:[ \t]*\n)+')
+FIELD_PATTERN = re.compile(rb'^(' + b'|'.join(PACKAGE_FIELDS) + rb'):[ \t]*(.*(?:\n[ \t].*)*)', re.M)
+LINE_BREAK = re.compile(rb'[ \t]*\n[ \t]*')
+
 
 class Logger:
   @staticmethod
@@ -49,7 +83,7 @@ class Logger:
       )
 
 class Downloader:
-  def __init__(self, proto, url, rootpath):
+  def __init__(self, proto, url, rootpath, threads=5, hash_check=False, cachedir=None):
       """
       Initializes the Downloader with protocol, URL, and root path.
 
@@ -57,6 +91,9 @@ class Downloader:
       proto (str): The protocol to use (e.g., 'http', 'https').
       url (str): The base URL for downloading.
       rootpath (str): The root path where files will be downloaded.
+      threads (int): Number of worker threads sharing the connection pool.
+      hash_check (bool): If True, existing files are checked against their SHA-256 hash, not only their size.
+      cachedir (str): Folder for the ETags kept between runs, outside of the mirror.
       """
       self.proto = proto
       self.url = url
@@ -64,36 +101,128 @@ class Downloader:
       self.downloaded_files = []  # List to store paths of downloaded files
       self.downloaded_count = 0  # Counter for successfully downloaded files
       self.skipped_count = 0  # Counter for skipped files
+      self.hash_check = hash_check
+      self.cachedir = cachedir
+      self._lock = threading.Lock()  # Guards the counters updated by worker threads
+      self.existing_files = None  # Files found on disk before mirroring, if scanned
+      self.checksums = {}  # Signed (SHA-256, size) of the index files, by local path
+      self.known_folders = set()  # Folders known to exist
+
+      self.bar = None  # Progress bar shared by all downloads, see start_progress
+
+      # Single session shared by all worker threads, so connections to the
+      # mirror are kept alive and reused instead of reopened for every file
+      self.session = requests.Session()
+      self.session.mount(f"{proto}://", HTTPAdapter(
+          pool_connections=1,
+          pool_maxsize=max(threads, 10),
+          pool_block=True,
+          max_retries=Retry(total=3, backoff_factor=0.2),
+      ))
+
+  def start_progress(self):
+      """
+      Opens the progress bar shared by all downloads. Its total grows as the
+      responses arrive.
+      """
+      self.bar = tqdm(total=0, unit='B', unit_scale=True, unit_divisor=1024)
+
+  def close(self):
+      """
+      Closes the HTTP session, releases the pooled connections and closes the progress bar.
+      """
+      self.session.close()
+      if self.bar is not None:
+          self.bar.close()
 
-  def download_directory(self, path, exclude_pattern="index.html*"):
+  def set_existing_files(self, file_list):
+      """
+      Records the files already on disk, so that download_file looks them up in
+      memory instead of querying the filesystem for every file.
+
+      Parameters:
+      file_list (iterable): The paths of the files already on disk.
+      """
+      self.existing_files = frozenset(os.path.normpath(file_path) for file_path in file_list)
+      self.known_folders.update(os.path.dirname(file_path) for file_path in self.existing_files)
+
+  def add_checksums(self, checksums):
+      """
+      Records the expected SHA-256 hash and size of files, as listed in a
+      Release file. download_file checks these files against them.
+
+      Parameters:
+      checksums (dict): (SHA-256, size) tuples keyed by local file path.
+      """
+      self.checksums.update((os.path.normpath(file_path), value) for file_path, value in checksums.items())
+
+  def _exists(self, file_path):
+      """
+      Checks whether a file exists, using the recorded files when available.
+
+      Parameters:
+      file_path (str): The path of the file.
+
+      Returns:
+      bool: True if the file exists.
+      """
+      if self.existing_files is None:
+          return os.path.exists(file_path)
+      return os.path.normpath(file_path) in self.existing_files
+
+  def download_directory(self, path, executor, exclude_pattern="index.html*"):
       """
       Downloads a directory from the specified path, excluding certain files.
 
+      The directory index is fetched with the shared session and every file
+      found in it (and in its subdirectories) is queued on the executor.
+
       Parameters:
       path (str): The path to the directory to download.
+      executor (Executor): The executor the file downloads are submitted to.
       exclude_pattern (str): Pattern of files to exclude from download.
-      """
-      parsed_url = path.split('/')[0]
-      
-      # Command to download the directory using wget
-      command = [
-          "wget", "-r", "-np", "-nH",
-          "-P", f"{self.rootpath}/{parsed_url}",
-          "--reject", exclude_pattern, f"{self.proto}://{path}"
-      ]
 
+      Returns:
+      list: The futures of the queued file downloads.
+      """
+      futures = []
       try:
-          # Run the wget command and suppress output
-          with open(os.devnull, 'w') as devnull:
-              subprocess.run(command, check=True, stdout=devnull, stderr=devnull)
-          logging.debug(f"Download completed successfully for {path}")
-          # Add downloaded files to the list
-          self._add_downloaded_files_from_directory(path)
-      except subprocess.CalledProcessError as e:
-          if e.returncode == 8:
-              logging.debug(f"File does not exist: {path}")
+          response = self.session.get(f"{self.proto}://{path}", timeout=(5, 60))
+          response.raise_for_status()
+      except requests.exceptions.HTTPError as e:
+          if response.status_code == 404:
+              logging.debug(f"Directory does not exist: {path}")
           else:
               logging.error(f"An error occurred: {e}")
+          return futures
+      except requests.exceptions.RequestException as e:
+          logging.error(f"An error occurred while listing {path}: {e}")
+          return futures
+
+      folder = os.path.normpath(f"{self.rootpath}/{path}")
+      for link in HREF_PATTERN.findall(response.content):
+          link = link.decode()
+          if "://" in link:
+              continue
+          name = unquote(link)
+          # Stay below the requested directory, like wget --no-parent. The check
+          # is done on the decoded name, since that is what ends up on disk.
+          if '..' in name.split('/') or not os.path.normpath(f"{folder}/{name}").startswith(folder + os.sep):
+              logging.debug(f"Skipping link outside of {path}: {link}")
+              continue
+          if fnmatch.fnmatch(name.rstrip('/'), exclude_pattern):
+              continue
+          if link.endswith('/'):
+              futures.extend(self.download_directory(f"{path}{link}", executor, exclude_pattern))
+          else:
+              futures.append(executor.submit(
+                  self.download_file,
+                  f"{self.proto}://{path}{link}",
+                  f"{self.rootpath}/{path}{name}"
+              ))
+
+      logging.debug(f"Queued {len(futures)} files from {path}")
+      return futures
 
   @staticmethod
   def verify_file_hash(file_path, hash_string):
@@ -103,13 +232,9 @@ class Downloader:
     :param hash_string: SHA-256 hash string to compare against.
     :return: True if the file's hash matches the provided hash string, False otherwise.
     """
-    sha256 = hashlib.sha256()
     try:
         with open(file_path, "rb") as file:
-            while chunk := file.read(8192):
-                sha256.update(chunk)
-        
-        file_hash = sha256.hexdigest()
+            file_hash = hashlib.file_digest(file, "sha256").hexdigest()
         
         return file_hash == hash_string
     except FileNotFoundError:
@@ -121,65 +246,187 @@ class Downloader:
 
 
 
-  def download_file(self, path, full_path, hash_string=None):
+  def download_file(self, path, full_path, hash_string=None, expected_size=None, publish=True):
       """
       Downloads a single file from the specified path.
 
       Parameters:
       path (str): The URL of the file to download.
       full_path (str): The full path where the file will be saved.
-      overwrite (bool): Whether to overwrite the file if it already exists.
+      hash_string (str): Expected SHA-256 hash of the file, if known.
+      expected_size (int): Expected size of the file in bytes, if known.
+      publish (bool): If False, a new download is left in the .part file, for
+      the caller to check and publish.
+
+      With a hash, an existing local copy is kept when its size matches (and its
+      hash, in hash_check mode), and a new download is verified while it is
+      written. Files listed in a Release file get their hash from it, and their
+      local copy is always hash checked. Without a hash, an existing local copy
+      is only downloaded again when the server reports it as modified
+      (If-Modified-Since / If-None-Match).
       """
-      folder = os.path.dirname(full_path)
-      if not os.path.exists(folder):
+      folder = os.path.dirname(os.path.normpath(full_path))
+      if folder not in self.known_folders:
           os.makedirs(folder, exist_ok=True)
+          self.known_folders.add(folder)
           logging.debug(f"Created directory: {folder}")
 
       file_name = os.path.basename(full_path)
-      if os.path.exists(full_path) and hash_string is not None:
-    #   if os.path.exists(full_path) and not overwrite:
-          if Downloader.verify_file_hash(full_path, hash_string):
-            logging.debug(f"File '{file_name}' already exists. Skipping download.")
-            self.skipped_count += 1  # Increment skipped count
-            return
-          elif hash_string != " True" :
+      check_hash = self.hash_check
+      if hash_string is None and os.path.normpath(full_path) in self.checksums:
+          # Index file listed in the Release file, trust only its signed hash
+          hash_string, expected_size = self.checksums[os.path.normpath(full_path)]
+          check_hash = True
+
+      if hash_string is not None and self._exists(full_path):
+          if expected_size is not None and os.path.getsize(full_path) != expected_size:
+              logging.info(f"File '{file_name}' already exists but size does not match. Overwriting.")
+          elif not check_hash or Downloader.verify_file_hash(full_path, hash_string):
+              logging.debug(f"File '{file_name}' already exists. Skipping download.")
+              with self._lock:
+                  self.skipped_count += 1  # Increment skipped count
+              return
+          else:
               logging.info(f"File '{file_name}' already exists but hash does not match. Overwriting.")
 
+      # Data is written to a .part file and only published once it is complete.
+      # Files with a known hash resume an interrupted download, since the hash
+      # check catches a partial file that belongs to another version.
+      part_path = f"{full_path}.part"
+      start = 0
+      if hash_string is not None and self._exists(part_path):
+          try:
+              start = os.path.getsize(part_path)
+          except FileNotFoundError:
+              # Already dropped during this run
+              start = 0
+      if expected_size is not None and start > expected_size:
+          os.remove(part_path)
+          start = 0
+
+      headers = {}
+      # ETags are kept out of the published tree
+      etag_path = None
+      if self.cachedir is not None:
+          etag_path = FileManager.cache_path(self.cachedir, self.rootpath, full_path, ".etag")
+      if start:
+          headers['Range'] = f"bytes={start}-"
+      elif hash_string is None and self._exists(full_path):
+          # Only transfer the file if it changed since the local copy was saved
+          headers['If-Modified-Since'] = formatdate(os.path.getmtime(full_path), usegmt=True)
+          if etag_path is not None and os.path.exists(etag_path):
+              try:
+                  with open(etag_path, 'r') as file:
+                      headers['If-None-Match'] = file.read().strip()
+              except OSError as e:
+                  logging.debug(f"Could not read cache {etag_path}: {e}")
+
+      response = None
       try:
           # Request the file from the URL
-          response = requests.get(path, stream=True)
+          response = self.session.get(path, stream=True, timeout=(5, 60), headers=headers)
+          if response.status_code == 304:
+              logging.debug(f"File '{file_name}' not modified. Skipping download.")
+              with self._lock:
+                  self.skipped_count += 1  # Increment skipped count
+              return
+          if response.status_code == 416 and start:
+              # The partial file does not fit the remote one, start over
+              response.close()
+              os.remove(part_path)
+              return self.download_file(path, full_path, hash_string, expected_size, publish)
           response.raise_for_status()
-          total_size = int(response.headers.get('content-length', 0))
-          with open(full_path, 'wb') as file, tqdm(
-              desc=file_name,
-              total=total_size,
-              unit='B',
-              unit_scale=True,
-              unit_divisor=1024
-          ) as bar:
-              for chunk in response.iter_content(chunk_size=8192):
+
+          if response.status_code != 206:
+              # The server sent the whole file, drop what was already there
+              start = 0
+          sha256 = None
+          if hash_string is not None:
+              if start:
+                  with open(part_path, 'rb') as file:
+                      sha256 = hashlib.file_digest(file, "sha256")
+              else:
+                  sha256 = hashlib.sha256()
+          if self.bar is not None:
+              with self._lock:
+                  self.bar.total += int(response.headers.get('content-length', 0))
+                  self.bar.refresh()
+          written = start
+          # Read straight from the urllib3 response, without the generator
+          # layers that iter_content adds around it
+          response.raw.decode_content = True
+          read = response.raw.read
+          with open(part_path, 'ab' if start else 'wb', buffering=CHUNK_SIZE) as file:
+              while chunk := read(CHUNK_SIZE):
                   file.write(chunk)
-                  bar.update(len(chunk))
+                  if sha256 is not None:
+                      sha256.update(chunk)
+                  written += len(chunk)
+                  if self.bar is not None:
+                      # tqdm counters are not atomic, update them under the lock
+                      with self._lock:
+                          self.bar.update(len(chunk))
+
+          if response.status_code == 206:
+              # Content-Range is "bytes <first>-<last>/<length>"
+              content_range = response.headers.get('Content-Range', '')
+              last = content_range.partition(' ')[2].partition('/')[0].partition('-')[2]
+              if last.isdigit() and written != int(last) + 1:
+                  logging.error(f"File '{file_name}' is incomplete ({written} bytes). It will be resumed on the next run.")
+                  return
+
+          # Never keep a file that does not match the Packages index or Release file
+          if ((expected_size is not None and written != expected_size)
+                  or (sha256 is not None and sha256.hexdigest() != hash_string)):
+              try:
+                  os.remove(part_path)
+              except FileNotFoundError:
+                  pass
+              logging.error(f"File '{file_name}' does not match its expected size or hash. Removed.")
+              return
+          saved_path = full_path if publish else part_path
+          if publish:
+              try:
+                  os.replace(part_path, full_path)
+              except FileNotFoundError:
+                  # The same file was queued twice, and the other worker already published it
+                  logging.debug(f"File '{file_name}' already published by another download.")
+                  return
+
+          # Keep the server timestamp and ETag for the next conditional request
+          last_modified = response.headers.get('Last-Modified')
+          if last_modified:
+              try:
+                  os.utime(saved_path, (time.time(), parsedate_to_datetime(last_modified).timestamp()))
+              except (TypeError, ValueError):
+                  logging.debug(f"Invalid Last-Modified header for '{file_name}': {last_modified}")
+          etag = response.headers.get('ETag')
+          # A staged file may still be rejected, its ETag must not be reused
+          if etag and hash_string is None and etag_path is not None and publish:
+              # The cache is only an optimisation, never fail the mirror over it
+              try:
+                  os.makedirs(os.path.dirname(etag_path), exist_ok=True)
+                  with open(etag_path, 'w') as file:
+                      file.write(etag)
+              except OSError as e:
+                  logging.debug(f"Could not write cache {etag_path}: {e}")
           logging.debug(f"File '{file_name}' downloaded successfully.")
-          self.downloaded_files.append(full_path)  # Add to the list
-          self.downloaded_count += 1  # Increment downloaded count
+          with self._lock:
+              self.downloaded_files.append(full_path)  # Add to the list
+              self.downloaded_count += 1  # Increment downloaded count
       
       except requests.exceptions.HTTPError as e:
           if response.status_code == 404:
               logging.debug(f"Failed to download the file: {e}")
           else:
               logging.error(f"An error occurred: {e}")
-
-  def _add_downloaded_files_from_directory(self, path):
-      """
-      Adds files downloaded by wget to the list of downloaded files.
-
-      Parameters:
-      path (str): The path to the directory where files were downloaded.
-      """
-      for root, _, files in os.walk(f"{self.rootpath}/{path}"):
-          for file in files:
-              self.downloaded_files.append(os.path.join(root, file))
+      except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+          logging.error(f"An error occurred while downloading {path}: {e}")
+      finally:
+          # A streamed response holds its pooled connection until it is closed,
+          # and the pool blocks once all of them are taken
+          if response is not None:
+              response.close()
 
   def get_downloaded_files(self):
       """
@@ -221,33 +468,8 @@ class PackageHandler:
       Returns:
       list: A list of dictionaries, each representing a package.
       """
-      packages = []
-      current_package = {}
-
-      with open(file_path, 'r') as file:
-          for line in file:
-              line = line.strip()
-              if not line:
-                  # If a blank line is encountered, save the current package and reset
-                  if current_package:
-                      packages.append(current_package)
-                      current_package = {}
-              else:
-                  if ': ' in line:
-                      # Split the line into key and value
-                      key, value = line.split(': ', 1)
-                      current_package[key] = value
-                  else:
-                      # Handle continuation lines
-                      last_key = next(reversed(current_package), None)
-                      if last_key:
-                          current_package[last_key] += ' ' + line
-
-          # Add the last package if the file doesn't end with a blank line
-          if current_package:
-              packages.append(current_package)
-
-      return packages
+      with open(file_path, 'rb') as file:
+          return PackageHandler.parse_packages_data(file.read())
 
   @staticmethod
   def extract_file(file_path):
@@ -258,17 +480,16 @@ class PackageHandler:
       file_path (str): The path to the file to extract.
 
       Returns:
-      str: The extracted data as a string.
+      bytes: The extracted data.
       """
+      # Read and decompress the whole file at once: much faster than the
+      # line-by-line decoding of the text-mode readers
+      with open(file_path, 'rb') as file:
+          data = file.read()
       if file_path.endswith(".xz"):
-          with lzma.open(file_path, 'rt') as file:
-              data = file.read()
+          data = lzma.decompress(data)
       elif file_path.endswith(".gz"):
-          with gzip.open(file_path, 'rt') as file:
-              data = file.read()
-      else:
-          with open(file_path, 'r') as file:
-              data = file.read()
+          data = gzip.decompress(data)
       
       # Get the current date and time
       current_time = datetime.now()
@@ -281,64 +502,183 @@ class PackageHandler:
       return data
 
   @staticmethod
-  def find_and_extract_packages(file_list):
+  def find_and_extract_packages(file_list, cachedir=None, rootpath=None):
       """
       Finds and extracts package data from a list of files.
 
       Parameters:
       file_list (list): A list of file paths to search for package files.
+      cachedir (str): Folder holding the parsed package files, if caching is wanted.
+      rootpath (str): The root path of the mirror, the package files are relative to it.
 
       Returns:
       list: A list of package dictionaries extracted from the files.
       """
       for file_path in file_list:
           if file_path.endswith("Packages") or file_path.endswith("Packages.xz") or file_path.endswith("Packages.gz"):
-              data = PackageHandler.extract_file(file_path)
-              # Parse the extracted data
-              return PackageHandler.parse_packages_data(data)
+              if cachedir is None:
+                  # Parse the extracted data
+                  return PackageHandler.parse_packages_data(PackageHandler.extract_file(file_path))
+              # Parse the file, or reuse the result of a previous run
+              return PackageHandler.parse_packages_cached(
+                  file_path, FileManager.cache_path(cachedir, rootpath, file_path, ".json"))
+
+  @staticmethod
+  def parse_packages_cached(file_path, cache_path):
+      """
+      Extracts and parses a package file, caching the result.
+
+      The parsed packages are saved as JSON together with the modification time
+      of the package file, so an unchanged file is not decompressed and parsed
+      again on the next run.
+
+      Parameters:
+      file_path (str): The path to the package file.
+      cache_path (str): The path of the cache file, outside of the mirror.
+
+      Returns:
+      list: A list of package dictionaries extracted from the file.
+      """
+      mtime = os.path.getmtime(file_path)
+      try:
+          with open(cache_path, 'r', encoding='utf-8') as file:
+              cached = json.load(file)
+          if cached["mtime"] == mtime:
+              logging.debug(f"Loaded parsed packages from {cache_path}")
+              return cached["packages"]
+      except FileNotFoundError:
+          pass
+      except Exception as e:
+          logging.debug(f"Ignoring unreadable cache {cache_path}: {e}")
+
+      data = PackageHandler.extract_file(file_path)
+      # Parse the extracted data
+      packages = PackageHandler.parse_packages_data(data)
+      try:
+          os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+          with open(cache_path, 'w', encoding='utf-8') as file:
+              json.dump({"mtime": mtime, "packages": packages}, file)
+      except OSError as e:
+          logging.debug(f"Could not write cache {cache_path}: {e}")
+      return packages
 
   @staticmethod
   def parse_packages_data(data):
       """
-      Parses package data from a string and returns a list of package dictionaries.
+      Parses package data and returns a list of package dictionaries.
+
+      Only the fields listed in PACKAGE_FIELDS are decoded and kept.
 
       Parameters:
-      data (str): The package data as a string.
+      data (bytes): The package data.
 
       Returns:
       list: A list of dictionaries, each representing a package.
       """
       packages = []
-      current_package = {}
-      lines = data.splitlines()
-
-      for line in lines:
-          line = line.strip()
-          if not line:
-              # If a blank line is encountered, save the current package and reset
-              if current_package:
-                  packages.append(current_package)
-                  current_package = {}
-          else:
-              if ': ' in line:
-                  # Split the line into key and value
-                  key, value = line.split(': ', 1)
-                  current_package[key] = value
-              else:
-                  # Handle continuation lines
-                  last_key = next(reversed(current_package), None)
-                  if last_key:
-                      current_package[last_key] += ' ' + line
-
-      # Add the last package if the data doesn't end with a blank line
-      if current_package:
-          packages.append(current_package)
+      # Bind the hot lookups to locals, this loop runs once per package
+      append = packages.append
+      findall = FIELD_PATTERN.findall
+      join_lines = LINE_BREAK.sub
+      names = PACKAGE_FIELDS
+
+      for record in RECORD_SEPARATOR.split(data):
+          fields = findall(record)
+          if not fields:
+              continue
+          package = {}
+          for key, value in fields:
+              if b'\n' in value:
+                  # Join continuation lines with a single space
+                  value = join_lines(b' ', value)
+              package[names[key]] = value.strip().decode('utf-8', 'replace')
+          append(package)
 
       return packages
 
+  @staticmethod
+  def parse_release_file(file_path):
+      """
+      Parses the SHA256 section of a Release (or InRelease) file.
+
+      Parameters:
+      file_path (str): The path to the Release file.
+
+      Returns:
+      dict: (SHA-256, size) tuples keyed by path relative to the distribution folder.
+      """
+      checksums = {}
+      in_sha256 = False
+
+      with open(file_path, 'r', encoding='utf-8') as file:
+          for line in file:
+              if not line.startswith((' ', '\t')):
+                  # A new field starts, only the lines below "SHA256:" are wanted
+                  in_sha256 = line.strip() == 'SHA256:'
+              elif in_sha256:
+                  parts = line.split()
+                  if len(parts) == 3:
+                      sha256, size, name = parts
+                      checksums[name] = (sha256, int(size))
+
+      return checksums
+
+  @staticmethod
+  def verify_release_signature(dist_path, keyring):
+      """
+      Verifies the signatures of the release files of a distribution: Release
+      against the detached Release.gpg, and the clearsigned InRelease. A file
+      still staged in its .part file is checked in place of the published one.
+
+      Parameters:
+      dist_path (str): The local folder of the distribution.
+      keyring (str): The GPG keyring holding the archive keys.
+
+      Returns:
+      list: The paths of the files with a valid signature, Release first.
+      """
+      gpg = gnupg.GPG(keyring=keyring)
+      paths = {}
+      for name in RELEASE_FILES:
+          part_path = f"{dist_path}/{name}.part"
+          paths[name] = part_path if os.path.exists(part_path) else f"{dist_path}/{name}"
+
+      verified = []
+      if os.path.exists(paths["Release"]) and os.path.exists(paths["Release.gpg"]):
+          with open(paths["Release.gpg"], 'rb') as file:
+              if gpg.verify_file(file, paths["Release"]).valid:
+                  verified.extend([paths["Release"], paths["Release.gpg"]])
+      if os.path.exists(paths["InRelease"]):
+          with open(paths["InRelease"], 'rb') as file:
+              if gpg.verify_file(file).valid:
+                  verified.append(paths["InRelease"])
+      return verified
+
 class FileManager:
   
 
+  @staticmethod
+  def cache_path(cachedir, rootpath, file_path, suffix):
+      """
+      Returns where the state kept for a mirrored file is stored. The cache
+      folder follows the layout of the root path, but stays out of the
+      published tree. Each root path gets its own subfolder, so mirrors
+      sharing a cache folder never see each other's state.
+
+      Parameters:
+      cachedir (str): The cache folder.
+      rootpath (str): The root path of the mirror.
+      file_path (str): The path of the mirrored file.
+      suffix (str): The suffix identifying the kind of state (e.g., '.json').
+
+      Returns:
+      str: The path of the cache file.
+      """
+      root = os.path.abspath(rootpath)
+      root_key = hashlib.sha256(root.encode()).hexdigest()[:16]
+      relative = os.path.relpath(os.path.abspath(file_path), root)
+      return os.path.join(cachedir, root_key, relative + suffix)
+
   @staticmethod
   def list_files_recursive(folder_path):
       """
@@ -347,15 +687,22 @@ class FileManager:
       Parameters:
       folder_path (str): The path to the folder to search.
 
-      Returns:
-      list: A list of file paths.
+      Yields:
+      str: The path of each file found.
       """
-      file_list = []
-      for root, _, files in os.walk(folder_path):
-          for file in files:
-              # Append the full file path to the list
-              file_list.append(os.path.join(root, file))
-      return file_list
+      pending = deque([folder_path])
+      while pending:
+          try:
+              with os.scandir(pending.popleft()) as entries:
+                  for entry in entries:
+                      # The entry type comes from the directory listing, no stat needed
+                      if entry.is_dir(follow_symlinks=False):
+                          pending.append(entry.path)
+                      elif entry.is_file(follow_symlinks=False):
+                          yield entry.path
+          except OSError:
+              # Unreadable or vanished folder, skip it like os.walk does
+              continue
 
   @staticmethod
   def list_files_in_folder(folder_path):
@@ -369,37 +716,50 @@ class FileManager:
       list: A list of file paths.
       """
       try:
-          # List all files and directories in the given folder
-          files = os.listdir(folder_path)
-          # Filter out directories, only keep files
-          file_paths = [os.path.join(folder_path, f) for f in files if os.path.isfile(os.path.join(folder_path, f))]
-          return file_paths
+          # List the folder, only keep files
+          with os.scandir(folder_path) as entries:
+              return [entry.path for entry in entries if entry.is_file()]
       except Exception as e:
           print(f"An error occurred: {e}")
           return []
 
   @staticmethod
-  def delete_files(file_list):
+  def delete_file(file_path):
       """
-      Deletes a list of files.
+      Deletes a single file, reporting any error instead of raising it.
+
+      Parameters:
+      file_path (str): The path of the file to be deleted.
+
+      Returns:
+      None
+      """
+      try:
+          # Attempt to remove the file
+          logging.info(f"Deleting: {file_path}")
+          os.remove(file_path)
+      except FileNotFoundError:
+          print(f"File not found: {file_path}")
+      except PermissionError:
+          print(f"Permission denied: {file_path}")
+      except Exception as e:
+          print(f"Error deleting {file_path}: {e}")
+
+  @staticmethod
+  def delete_files(file_list, threads=5):
+      """
+      Deletes a list of files, several at a time.
 
       Parameters:
       file_list (list): A list of file paths to be deleted.
+      threads (int): Number of files deleted in parallel.
 
       Returns:
       None
       """
-      for file_path in file_list:
-          try:
-              # Attempt to remove the file
-              os.remove(file_path)
-              print(f"Deleted: {file_path}")
-          except FileNotFoundError:
-              print(f"File not found: {file_path}")
-          except PermissionError:
-              print(f"Permission denied: {file_path}")
-          except Exception as e:
-              print(f"Error deleting {file_path}: {e}")
+      # unlink() releases the GIL, so the calls overlap across threads
+      with ThreadPoolExecutor(max_workers=threads) as executor:
+          list(executor.map(FileManager.delete_file, file_list))
 
 class RepositoryManage:
 
@@ -411,85 +771,262 @@ class RepositoryManage:
         args: An object containing configuration parameters such as protocol, URL, root path, etc.
         """
         self.args = args
-        self.downloader = Downloader(args.proto, args.url, self.args.rootpath)
+        self.downloader = Downloader(args.proto, args.url, self.args.rootpath, self.args.threads, self.args.hash, self.args.cachedir)
 
     def mirror_repository(self):
         """
         Mirrors a repository by downloading necessary files and directories.
-        """
-        link_list = []
 
-        # List all files in the root path before filtering
-        # file_list = FileManager.list_files_recursive(f"{self.args.rootpath}/{self.args.url}")
-        # logging.debug(f"Files in root path before filtering: {file_list}")
-
-        futures = []  # Maintain a single futures list
-        with ThreadPoolExecutor(max_workers=self.args.threads) as executor:
-            for distribution in self.args.distributions:
-                # Download release files for each distribution
-                for cert in ["InRelease", "Release", "Release.gpg"]:
-                    common_path = f"{self.args.url}/{self.args.inpath}/dists/{distribution}/{cert}"
-                    futures.append(executor.submit(
-                        self.downloader.download_file,
-                        f"{self.args.proto}://{common_path}",
-                        f"{self.args.rootpath}/{common_path}"
-                    ))
-
-                for component in self.args.components:
-                    # Download directories for each component
-                    self.downloader.download_directory(f"{self.args.url}/{self.args.inpath}/dists/{distribution}/{component}/i18n/")
-                    self.downloader.download_directory(f"{self.args.url}/{self.args.inpath}/dists/{distribution}/{component}/source/")
-
-                    for arch in self.args.architectures:
-                        # Download architecture-specific files
-                        common_path = f"{self.args.url}/{self.args.inpath}/dists/{distribution}/{component}/Contents-{arch}.gz"
-                        futures.append(executor.submit(
-                            self.downloader.download_file,
-                            f"{self.args.proto}://{common_path}",
-                            f"{self.args.rootpath}/{common_path}"
-                        ))
-                        self.downloader.download_directory(f"{self.args.url}/{self.args.inpath}/dists/{distribution}/{component}/binary-{arch}/")
-                        self.downloader.download_directory(f"{self.args.url}/{self.args.inpath}/dists/{distribution}/{component}/debian-installer/binary-{arch}/")
-                        
-                        # List and process package files
-                        save_path = f"{self.args.rootpath}/{self.args.url}/{self.args.inpath}/dists/{distribution}/{component}/binary-{arch}/"
-                        pack_files = FileManager.list_files_in_folder(save_path)
-                        packages_info = PackageHandler.find_and_extract_packages(pack_files)
-                        logging.debug(f"Pages Info: {len(packages_info)}")
-                        for index, package in enumerate(packages_info, start=1):
-                            logging.debug(f"Serial Number: {index}")
-                            logging.debug(f"Package: {package.get('Package')}")
-                            logging.debug(f"Version: {package.get('Version')}")
-                            logging.debug(f"Description: {package.get('Description')}")
-                            logging.debug(f"Filename: {package.get('Filename')}")
-                            logging.debug(f"SHA256: {package.get('SHA256')}")
-                            downloadlink = f"{self.args.proto}://{self.args.url}/{self.args.inpath}/{package.get('Filename')}"
-                            filesave = f"{self.args.rootpath}/{self.args.url}/{self.args.inpath}/{package.get('Filename')}"
-                            link_list.append(filesave)
-                            if self.args.hash:
-                                futures.append(executor.submit(
-                                    self.downloader.download_file,
-                                    downloadlink,
-                                    filesave,
-                                    package.get('SHA256'),
-                                ))
-                            else:
-                                futures.append(executor.submit(
-                                    self.downloader.download_file,
-                                    downloadlink,
-                                    filesave,
-                                ))
-        
+        Release files, index directories and packages are scheduled as a single
+        graph of tasks: the packages of a binary-<arch> directory are queued as
+        soon as its Packages index is on disk, so all phases overlap.
+        """
+        if self.args.keyring and gnupg is None:
+            logging.error("The python-gnupg package is required to verify Release files with --keyring.")
+            return
 
-        # Wait for all download tasks to complete
-        for future in as_completed(futures):
-            future.result()
+        self.link_list = []
+        self._pending = queue.Queue()  # Futures of every task scheduled so far
+        self._scheduled = set()  # Package files already queued for download
+        self._scheduled_lock = threading.Lock()
+
+        # Scan the root path once, so the downloader does not have to check
+        # the filesystem for every single file
+        self.downloader.set_existing_files(FileManager.list_files_recursive(f"{self.args.rootpath}/{self.args.url}"))
+        logging.debug(f"Files in root path before mirroring: {len(self.downloader.existing_files)}")
+
+        self.downloader.start_progress()
+        try:
+            with ThreadPoolExecutor(max_workers=self.args.threads) as executor:
+                self._executor = executor
+                for distribution in self.args.distributions:
+                    # Index files are only fetched once the Release file is checked
+                    self._when_all(self.fetch_release(distribution), self.fetch_distribution, distribution)
+
+                # Wait for all download tasks to complete. Every task is queued
+                # before the task that scheduled it completes, so once the queue
+                # is empty the whole graph has run.
+                while not self._pending.empty():
+                    self._pending.get().result()
+        finally:
+            # Release the pooled connections once every download is done
+            self.downloader.close()
         logging.debug(f"Mirror cloned successfully.") 
 
         # Extend the link list with downloaded files
-        link_list.extend(self.downloader.get_downloaded_files())
-        # logging.debug(f"Stored {len(file_list)} files.")
-        logging.debug(f"link_list {len(link_list)}")
+        self.link_list.extend(self.downloader.get_downloaded_files())
+        logging.debug(f"link_list {len(self.link_list)}")
+
+    def fetch_release(self, distribution):
+        """
+        Queues the download of the release files of a distribution. With a
+        keyring, new copies are kept in their .part file until their signature
+        is checked.
+
+        Parameters:
+        distribution (str): The distribution (e.g., bookworm).
+
+        Returns:
+        list: The futures of the queued downloads.
+        """
+        futures = []
+        for cert in RELEASE_FILES:
+            common_path = f"{self.args.url}/{self.args.inpath}/dists/{distribution}/{cert}"
+            if self.args.keyring and os.path.exists(f"{self.args.rootpath}/{common_path}.part"):
+                # Left over by an interrupted run, it must not be checked in place of the new copy
+                os.remove(f"{self.args.rootpath}/{common_path}.part")
+            futures.append(self._submit(
+                self.downloader.download_file,
+                f"{self.args.proto}://{common_path}",
+                f"{self.args.rootpath}/{common_path}",
+                None,
+                None,
+                not self.args.keyring
+            ))
+        return futures
+
+    def fetch_distribution(self, distribution):
+        """
+        Checks the Release file of a distribution, then queues the download of
+        its index files. The SHA-256 hashes listed in the Release file are
+        used to verify the index files. With a keyring, only the release files
+        with a valid signature are published, the previous copies are kept
+        otherwise.
+
+        Parameters:
+        distribution (str): The distribution (e.g., bookworm).
+        """
+        dist_path = f"{self.args.rootpath}/{self.args.url}/{self.args.inpath}/dists/{distribution}"
+        if self.args.keyring:
+            verified = PackageHandler.verify_release_signature(dist_path, self.args.keyring)
+            for name in RELEASE_FILES:
+                part_path = f"{dist_path}/{name}.part"
+                if not os.path.exists(part_path):
+                    continue
+                if part_path in verified:
+                    os.replace(part_path, f"{dist_path}/{name}")
+                else:
+                    os.remove(part_path)
+                    logging.error(f"Invalid or missing signature for {name} of {distribution}. Keeping the previous copy.")
+            # The hashes must come from the very file whose signature was checked
+            release_path = next((path.removesuffix(".part") for path in verified
+                                 if not path.endswith((".gpg", ".gpg.part"))), None)
+            if release_path is None:
+                logging.error(f"Invalid or missing Release signature for {distribution}. Skipping it.")
+                return
+        else:
+            release_path = next((f"{dist_path}/{release}" for release in ["Release", "InRelease"]
+                                 if os.path.exists(f"{dist_path}/{release}")), None)
+
+        if release_path is not None:
+            checksums = PackageHandler.parse_release_file(release_path)
+            self.downloader.add_checksums({f"{dist_path}/{name}": value for name, value in checksums.items()})
+
+        for component in self.args.components:
+            self._submit(self.fetch_sources, distribution, component)
+            for arch in self.args.architectures:
+                self._submit(self.fetch_indices, distribution, component, arch)
+
+    def fetch_sources(self, distribution, component):
+        """
+        Queues the download of the i18n and source directories of a component.
+
+        Parameters:
+        distribution (str): The distribution (e.g., bookworm).
+        component (str): The component (e.g., main).
+        """
+        for folder in ["i18n", "source"]:
+            self._track(self.downloader.download_directory(
+                f"{self.args.url}/{self.args.inpath}/dists/{distribution}/{component}/{folder}/",
+                self._executor
+            ))
+
+    def fetch_indices(self, distribution, component, arch):
+        """
+        Queues the download of the architecture-specific index files, followed
+        by the packages listed in the Packages index.
+
+        Parameters:
+        distribution (str): The distribution (e.g., bookworm).
+        component (str): The component (e.g., main).
+        arch (str): The architecture (e.g., amd64).
+        """
+        # Download architecture-specific files
+        common_path = f"{self.args.url}/{self.args.inpath}/dists/{distribution}/{component}/Contents-{arch}.gz"
+        self._submit(
+            self.downloader.download_file,
+            f"{self.args.proto}://{common_path}",
+            f"{self.args.rootpath}/{common_path}"
+        )
+        index_futures = self._track(self.downloader.download_directory(
+            f"{self.args.url}/{self.args.inpath}/dists/{distribution}/{component}/binary-{arch}/",
+            self._executor
+        ))
+        self._track(self.downloader.download_directory(
+            f"{self.args.url}/{self.args.inpath}/dists/{distribution}/{component}/debian-installer/binary-{arch}/",
+            self._executor
+        ))
+
+        # The Packages index must be on disk before it can be parsed
+        save_path = f"{self.args.rootpath}/{self.args.url}/{self.args.inpath}/dists/{distribution}/{component}/binary-{arch}/"
+        self._when_all(index_futures, self.fetch_packages, save_path)
+
+    def fetch_packages(self, save_path):
+        """
+        Parses the Packages index found in a folder and queues the download of
+        every package it lists.
+
+        Parameters:
+        save_path (str): The local binary-<arch> folder holding the Packages index.
+        """
+        # List and process package files
+        pack_files = FileManager.list_files_in_folder(save_path)
+        packages_info = PackageHandler.find_and_extract_packages(pack_files, self.args.cachedir, self.args.rootpath)
+        if not packages_info:
+            logging.debug(f"No packages found in {save_path}")
+            return
+        logging.debug(f"Pages Info: {len(packages_info)}")
+        for index, package in enumerate(packages_info, start=1):
+            logging.debug(f"Serial Number: {index}")
+            logging.debug(f"Package: {package.get('Package')}")
+            logging.debug(f"Version: {package.get('Version')}")
+            logging.debug(f"Description: {package.get('Description')}")
+            logging.debug(f"Filename: {package.get('Filename')}")
+            logging.debug(f"SHA256: {package.get('SHA256')}")
+
+            # The same pool file is listed by several Packages indices (e.g.
+            # Architecture: all), make sure it is downloaded only once
+            with self._scheduled_lock:
+                if package.get('Filename') in self._scheduled:
+                    continue
+                self._scheduled.add(package.get('Filename'))
+
+            downloadlink = f"{self.args.proto}://{self.args.url}/{self.args.inpath}/{package.get('Filename')}"
+            filesave = f"{self.args.rootpath}/{self.args.url}/{self.args.inpath}/{package.get('Filename')}"
+            self.link_list.append(filesave)
+            size = package.get('Size')
+            self._submit(
+                self.downloader.download_file,
+                downloadlink,
+                filesave,
+                package.get('SHA256'),
+                int(size) if size else None,
+            )
+
+    def _submit(self, fn, *args):
+        """
+        Submits a task to the executor and records its future as pending.
+
+        Returns:
+        Future: The future of the submitted task.
+        """
+        return self._track([self._executor.submit(fn, *args)])[0]
+
+    def _track(self, futures):
+        """
+        Records futures created outside of _submit as pending.
+
+        Returns:
+        list: The same futures.
+        """
+        for future in futures:
+            self._pending.put(future)
+        return futures
+
+    def _when_all(self, futures, fn, *args):
+        """
+        Submits a task to the executor once all the given futures are done.
+
+        A placeholder future stays pending until the task has been submitted,
+        so mirror_repository keeps waiting for it.
+
+        Parameters:
+        futures (list): The futures to wait for.
+        fn (callable): The task to submit.
+        """
+        if not futures:
+            self._submit(fn, *args)
+            return
+
+        placeholder = Future()
+        self._pending.put(placeholder)
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def on_done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            try:
+                self._submit(fn, *args)
+            except Exception as e:
+                placeholder.set_exception(e)
+            else:
+                placeholder.set_result(None)
+
+        for future in futures:
+            future.add_done_callback(on_done)
 
     def remove_repository(self):
         """
@@ -502,7 +1039,10 @@ class RepositoryManage:
                     # List and process package files
                     save_path = f"{self.args.rootpath}/{self.args.url}/{self.args.inpath}/dists/{distribution}/{component}/binary-{arch}/"
                     pack_files = FileManager.list_files_in_folder(save_path)
-                    packages_info = PackageHandler.find_and_extract_packages(pack_files)
+                    packages_info = PackageHandler.find_and_extract_packages(pack_files, self.args.cachedir, self.args.rootpath)
+                    if not packages_info:
+                        logging.debug(f"No packages found in {save_path}")
+                        continue
                     logging.debug(f"Pages Info: {len(packages_info)}")
                     for index, package in enumerate(packages_info, start=1):
                         logging.debug(f"Serial Number: {index}")
@@ -523,18 +1063,14 @@ class RepositoryManage:
         # Proceed based on user input
         if user_input == 'y':
             # Code to delete the files
-            for file_path in file_list:
+            FileManager.delete_files(file_list, self.args.threads)
+            # Remove the folder of every distribution
+            for distribution in self.args.distributions:
+                dist_path = f"{self.args.rootpath}/{self.args.url}/{self.args.inpath}/dists/{distribution}"
                 try:
-                    logging.info(f"Deleting: {file_path}")
-                    os.remove(file_path)
+                    shutil.rmtree(dist_path)
                 except FileNotFoundError:
-                    print(f"File not found: {file_path}")
-                except PermissionError:
-                    print(f"Permission denied: {file_path}")
-                except Exception as e:
-                    print(f"Error deleting {file_path}: {e}")
-            # Remove the distribution folder
-            shutil.rmtree(f"{self.args.rootpath}/{self.args.url}/{self.args.inpath}/dists/{distribution}")
+                    print(f"Folder not found: {dist_path}")
         else:
             print("Operation cancelled.")
 
@@ -553,8 +1089,11 @@ def main():
   parser.add_argument("--components", required=True, nargs='+', help="List of components (e.g., main contrib non-free)")
   parser.add_argument("--architectures", required=True, nargs='+', help="List of architectures (e.g., amd64 i386 arm64 armel armhf ppc64el s390x riscv64)")
   parser.add_argument("--rootpath", required=True, help="Local root path to save files (e.g, /var/www/html/apt)")
+  parser.add_argument("--cachedir", default=os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "mirep"),
+                      help="Folder for the state kept between runs, outside of the mirror (default: ~/.cache/mirep)")
   parser.add_argument("--threads", type=int, default=5, help="Number of threads to use (default: 5)")
-  parser.add_argument("--hash", action='store_true', help="If the file is already downloaded, check the hash")
+  parser.add_argument("--keyring", help="GPG keyring used to verify the Release files (e.g., /usr/share/keyrings/debian-archive-keyring.gpg), requires python-gnupg")
+  parser.add_argument("--hash", action='store_true', help="If the file is already downloaded, check the hash (by default only the size is checked)")
   parser.add_argument("--remove", action='store_true', help="Remove local repository")
   parser.add_argument("--verbose", action='store_true', help="Verbose mode")
   parser.add_argument("--version", action='version', version=f"%(prog)s {VERSION}")